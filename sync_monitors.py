@@ -1,10 +1,29 @@
 import os
+import asyncio
+import functools
+import aiohttp
+import asyncssh
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-import subprocess
+import logging
 import time
 import platform
+import socket
 import sys
+from ipaddress import IPv4Address
+
+# Route output through logging: timestamps per line and one handler shared by
+# concurrent tasks. The handler is attached to this script's logger only, so
+# library loggers (asyncssh logs every connect/auth/disconnect at INFO) stay quiet.
+logger = logging.getLogger("sync_monitors")
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+logger.addHandler(_handler)
+logger.setLevel(logging.INFO)
+logger.propagate = False
 
 # Configuration
 CONFIG_URL = os.getenv("HOSTS_CONFIG_URL")
@@ -20,25 +39,125 @@ HEADERS = {
 }
 
 if not UPTIMEROBOT_API_KEY:
-    print("Error: Main_API_key not set.")
+    logger.error("Error: Main_API_key not set.")
     exit(1)
 
+# Local state persisted between runs. Deliberately not uploaded to the Actions
+# cache: it maps ssh_host to origin IPs that the Access tunnels exist to hide.
+CACHE_DIR = ".cache"
+# Last known IP per ssh_host (only useful for re-runs within IP_CACHE_TTL)
+IP_CACHE_FILE = os.path.join(CACHE_DIR, "ip_cache.json")
+IP_CACHE_TTL = 3600
+# Last downloaded server config and its ETag/Last-Modified validators. The body
+# comes from a secret URL, so it is never written to disk on CI runners.
+CONFIG_CACHE_FILE = os.path.join(CACHE_DIR, "config.json")
+CONFIG_META_FILE = os.path.join(CACHE_DIR, "config_meta.json")
+CONFIG_CACHE_ENABLED = not os.getenv("CI")
+
+# Remote egress IP lookup: one UDP DNS query instead of an HTTPS round trip.
+# dig's output is only used if it contains a dotted-quad line, so curl runs
+# whenever dig is missing, fails, or prints only diagnostics (";; timed out").
+# +time=2 +tries=1 keeps a dead UDP path from eating the 45s probe budget.
+IP_PROBE_CMD = (
+    'ip=$(dig +short +time=2 +tries=1 -4 A myip.opendns.com @resolver1.opendns.com 2>/dev/null'
+    " | grep -E '^[0-9]+(\\.[0-9]+){3}$'); "
+    '[ -n "$ip" ] && echo "$ip" || curl -s -4 ifconfig.me'
+)
+
+# Process-local DNS cache: every API call hits the same few hostnames, so resolve
+# each one once per DNS_CACHE_TTL instead of on every new connection.
+DNS_CACHE_TTL = 300
+DNS_CACHE_MAXSIZE = 256
+_dns_cache = {}
+_getaddrinfo = socket.getaddrinfo
+
+def _cached_getaddrinfo(*args, **kwargs):
+    key = (args, tuple(sorted(kwargs.items())))
+    now = time.monotonic()
+    hit = _dns_cache.get(key)
+    if hit and hit[0] > now:
+        return hit[1]
+    result = _getaddrinfo(*args, **kwargs)
+    if len(_dns_cache) >= DNS_CACHE_MAXSIZE:
+        _dns_cache.clear()
+    _dns_cache[key] = (now + DNS_CACHE_TTL, result)
+    return result
+
+# Both urllib3 (requests) and aiohttp's default resolver go through socket.getaddrinfo
+socket.getaddrinfo = _cached_getaddrinfo
+
+# Shared session so every API call reuses the same keep-alive TLS connection
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+))
+
+def load_cache(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_cache(path, data):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(data, f)
+    except OSError as e:
+        logger.warning("Failed to save cache %s: %s", path, e)
+
 def get_server_list():
+    # Revalidate the cached copy instead of re-downloading an unchanged config
+    cached = load_cache(CONFIG_CACHE_FILE) if CONFIG_CACHE_ENABLED else None
+    meta = load_cache(CONFIG_META_FILE, {}) if cached is not None else {}
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
     try:
-        print(f"Fetching config from {CONFIG_URL}...")
-        resp = requests.get(CONFIG_URL, timeout=10)
+        logger.info("Fetching config from %s...", CONFIG_URL)
+        resp = requests.get(CONFIG_URL, headers=headers, timeout=10)
+        if resp.status_code == 304:
+            logger.info("Config not modified, using cached copy.")
+            return cached
         resp.raise_for_status()
-        return resp.json()
+        servers = resp.json()
+        if CONFIG_CACHE_ENABLED:
+            save_cache(CONFIG_CACHE_FILE, servers)
+            save_cache(CONFIG_META_FILE, {
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified')
+            })
+        return servers
     except Exception as e:
-        print(f"Failed to fetch config: {e}")
+        logger.error("Failed to fetch config: %s", e)
         return []
 
-def get_cloudflared_binary():
+def normalize_ip(value):
+    """
+    Canonical form of a monitor URL/IP so cosmetic differences (whitespace,
+    trailing slash) don't trigger a PATCH.
+    """
+    value = (value or "").strip().rstrip("/")
+    try:
+        return str(IPv4Address(value))
+    except ValueError:
+        return value
+
+@functools.lru_cache(maxsize=4)
+def get_cloudflared_binary(cpu_type=None):
     """
-    Determines which cloudflared binary to use based on the LOCAL system architecture.
-    The ProxyCommand runs on the Runner (Client), not the Target Server.
+    Determines which cloudflared binary to use. By default this is based on the
+    LOCAL system architecture, since the ProxyCommand runs on the Runner (Client),
+    not the Target Server. Pass cpu_type to pick a specific build instead.
     """
-    machine = platform.machine().lower()
+    machine = (cpu_type or platform.machine()).lower()
     
     # Map platform.machine() to our binary suffix
     if "aarch64" in machine or "arm64" in machine:
@@ -51,62 +170,93 @@ def get_cloudflared_binary():
     binary_path = os.path.join("bin", f"cloudflared-linux-{arch}")
     return binary_path
 
-def get_public_ip(ssh_host, cpu_type_ignored):
+# The runner's architecture can't change mid-run, so resolve the binary once
+CLOUDFLARED_BIN = get_cloudflared_binary()
+
+# Every probe would otherwise burn its full SSH timeout before failing
+if not (os.path.isfile(CLOUDFLARED_BIN) and os.access(CLOUDFLARED_BIN, os.X_OK)):
+    logger.error("Error: %s is missing or not executable.", CLOUDFLARED_BIN)
+    sys.exit(1)
+
+async def get_public_ip(ssh_host, cpu_type_ignored):
     if not SSH_USER or not SSH_PASS:
-        print("Skipping IP fetch: SSH credentials missing.")
+        logger.warning("Skipping IP fetch: SSH credentials missing.")
         return None
 
     # We use local architecture for the proxy binary, unrelated to target cpu_type
-    cloudflared_bin = get_cloudflared_binary()
+    cloudflared_bin = CLOUDFLARED_BIN
     
     # Using ProxyCommand with specific binary
     # Note: We must ensure the binary is executable (chmod +x handled in workflow)
-    proxy_cmd = f"{cloudflared_bin} access ssh --hostname {ssh_host}"
-    
-    cmd = [
-        "sshpass", "-p", SSH_PASS,
-        "ssh", 
-        "-o", f"ProxyCommand={proxy_cmd}",
-        "-o", "StrictHostKeyChecking=no",
-        "-o", "ConnectTimeout=20",
-        f"{SSH_USER}@{ssh_host}",
-        "curl -s -4 ifconfig.me"
-    ]
+    # Each ssh_host is its own Access application, so there is no shared edge
+    # session to pre-warm; main() already opens at most one tunnel per host.
+    proxy_cmd = [cloudflared_bin, "access", "ssh", "--hostname", ssh_host]
+
+    async def probe():
+        # known_hosts=None mirrors StrictHostKeyChecking=no
+        async with asyncssh.connect(
+            ssh_host,
+            username=SSH_USER,
+            password=SSH_PASS,
+            known_hosts=None,
+            proxy_command=proxy_cmd,
+            connect_timeout=20
+        ) as conn:
+            return await conn.run(IP_PROBE_CMD)
 
     try:
-        print(f"Connecting to {ssh_host} using {cloudflared_bin}...")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=45)
-        if result.returncode == 0:
+        logger.info("Connecting to %s using %s...", ssh_host, cloudflared_bin)
+        result = await asyncio.wait_for(probe(), timeout=45)
+        if result.exit_status == 0:
             ip = result.stdout.strip()
-            if len(ip.split('.')) == 4:
-                return ip
-            else:
-                print(f"Invalid IP from {ssh_host}: {ip}")
+            try:
+                return str(IPv4Address(ip))
+            except ValueError:
+                logger.warning("Invalid IP from %s: %s", ssh_host, ip)
         else:
-            print(f"SSH failed for {ssh_host}: {result.stderr}")
-    except subprocess.TimeoutExpired:
-        print(f"SSH timed out for {ssh_host}")
+            logger.warning("SSH failed for %s: %s", ssh_host, result.stderr)
+    except asyncio.TimeoutError:
+        logger.warning("SSH timed out for %s", ssh_host)
     except Exception as e:
-        print(f"Error checking {ssh_host}: {e}")
+        logger.error("Error checking %s: %s", ssh_host, e)
     
     return None
 
-def get_current_monitors():
+def get_current_monitors(needed=None):
+    """
+    Returns {friendlyName: {'id', 'url'}}, following V3 pagination (nextLink).
+    If `needed` is given, only monitors with those names are kept.
+    Returns None if the listing could not be fetched completely, so callers
+    never mistake a failed page for "monitor does not exist".
+    """
     url = f"{API_BASE}/monitors"
+    seen = set()
+    monitors = {}
     try:
-        resp = requests.get(url, headers=HEADERS)
-        data = resp.json()
-        # V3 Response has 'data' key, not 'stat'
-        if 'data' in data:
-            return {m['friendlyName']: m for m in data.get('data', [])}
-        else:
-            print(f"API Error (Get): {data}")
-            return {}
+        while url:
+            if url in seen:
+                logger.error("API Error (Get): pagination loop at %s", url)
+                return None
+            seen.add(url)
+            resp = SESSION.get(url, timeout=10)
+            data = orjson.loads(resp.content)
+            # V3 Response has 'data' key, not 'stat'
+            if 'data' not in data:
+                logger.error("API Error (Get): %s", data)
+                return None
+            # Keep only the fields main() reads, so unrelated payload is freed per page
+            monitors.update(
+                (m['friendlyName'], {'id': m['id'], 'url': m.get('url')})
+                for m in data['data']
+                if needed is None or m['friendlyName'] in needed
+            )
+            url = data.get('nextLink')
+        return monitors
     except Exception as e:
-        print(f"Failed to fetch monitors: {e}")
-        return {}
+        logger.error("Failed to fetch monitors: %s", e)
+        return None
 
-def create_monitor(name, url):
+async def create_monitor(session, name, url):
     api_url = f"{API_BASE}/monitors"
     # V3 Payload: friendlyName (camelCase), type (string enum)
     payload = {
@@ -117,68 +267,128 @@ def create_monitor(name, url):
     }
     
     try:
-        resp = requests.post(api_url, json=payload, headers=HEADERS)
-        data = resp.json()
+        async with session.post(api_url, json=payload) as resp:
+            data = await resp.json(content_type=None)
         if data.get('stat') == 'ok':
-            print(f"[CREATED] {name} -> {url}")
+            logger.info("[CREATED] %s -> %s", name, url)
         else:
-            print(f"[CREATE FAIL] {name}: {data.get('error')}")
+            logger.warning("[CREATE FAIL] %s: %s", name, data.get('error'))
     except Exception as e:
-        print(f"[CREATE ERROR] {name}: {e}")
+        logger.error("[CREATE ERROR] %s: %s", name, e)
 
-def update_monitor(monitor_id, name, new_url):
+async def update_monitor(session, monitor_id, name, new_url):
     api_url = f"{API_BASE}/monitors/{monitor_id}"
     payload = {
         'url': new_url
     }
     
     try:
-        resp = requests.patch(api_url, json=payload, headers=HEADERS)
-        data = resp.json()
+        async with session.patch(api_url, json=payload) as resp:
+            data = await resp.json(content_type=None)
         if data.get('stat') == 'ok':
-            print(f"[UPDATED] {name} -> {new_url}")
+            logger.info("[UPDATED] %s -> %s", name, new_url)
         else:
-            print(f"[UPDATE FAIL] {name}: {data.get('error')}")
+            logger.warning("[UPDATE FAIL] %s: %s", name, data.get('error'))
     except Exception as e:
-        print(f"[UPDATE ERROR] {name}: {e}")
+        logger.error("[UPDATE ERROR] %s: %s", name, e)
 
-def main():
+async def main():
     servers = get_server_list()
     if not servers:
-        print("No servers found.")
+        logger.info("No servers found.")
+        return
+
+    servers = [s for s in servers if s.get('name') and s.get('ssh_host')]
+
+    ip_cache = load_cache(IP_CACHE_FILE, {})
+    now = time.time()
+
+    def cached_ip(host):
+        entry = ip_cache.get(host)
+        if entry is not None and entry['ts'] > now - IP_CACHE_TTL:
+            return entry['ip']
+        return None
+
+    async def probe_hosts(hosts):
+        # Probe hosts concurrently; each probe is dominated by SSH/tunnel latency
+        if hosts:
+            logger.info("Resolving public IPs for %s hosts...", len(hosts))
+        probes = await asyncio.gather(
+            *(get_public_ip(host, cpu_type) for host, cpu_type in hosts.items()),
+            return_exceptions=True
+        )
+        return dict(zip(hosts, probes))
+
+    # Servers sharing an ssh_host share one connection and one probe
+    hosts = {}
+    for s in servers:
+        hosts.setdefault(s['ssh_host'], s.get('cpu_type', 'amd64'))
+
+    # Listing monitors is blocking I/O: run it in a worker thread while hosts
+    # without a fresh cached IP are probed, since those need a probe regardless
+    uncached = {host: cpu_type for host, cpu_type in hosts.items() if cached_ip(host) is None}
+    monitors_task = asyncio.ensure_future(
+        asyncio.to_thread(get_current_monitors, {s['name'] for s in servers})
+    )
+    ips = await probe_hosts(uncached)
+    current_monitors = await monitors_task
+    if current_monitors is None:
+        logger.error("Monitor listing incomplete. Skipping all updates to avoid duplicates.")
         return
+    logger.info("Found %s existing monitors.", len(current_monitors))
+
+    # A cached IP is only trusted if it already matches every monitor on that host
+    stale = {s['ssh_host'] for s in servers
+             if normalize_ip(current_monitors.get(s['name'], {}).get('url'))
+             != cached_ip(s['ssh_host'])}
+    recheck = {host: cpu_type for host, cpu_type in hosts.items()
+               if host not in uncached and host in stale}
+    for host in hosts:
+        if host not in uncached and host not in recheck:
+            ips[host] = cached_ip(host)
+            logger.info("Using cached IP for %s: %s", host, ips[host])
+    ips.update(await probe_hosts(recheck))
+
+    for host in {**uncached, **recheck}:
+        ip = ips[host]
+        if ip and not isinstance(ip, Exception):
+            ip_cache[host] = {'ip': ip, 'ts': now}
+    if uncached or recheck:
+        save_cache(IP_CACHE_FILE, ip_cache)
+    results = [ips[s['ssh_host']] for s in servers]
+
+    # Collect mutations first, then send them concurrently over one connection pool
+    connector = aiohttp.TCPConnector(limit=20)
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector) as session:
+        ops = []
+        for server, public_ip in zip(servers, results):
+            name = server['name']
+            cpu_type = server.get('cpu_type', 'amd64')
 
-    current_monitors = get_current_monitors()
-    print(f"Found {len(current_monitors)} existing monitors.")
-
-    for server in servers:
-        name = server.get('name')
-        ssh_host = server.get('ssh_host')
-        cpu_type = server.get('cpu_type', 'amd64')
-        
-        if not name or not ssh_host:
-            continue
-
-        print(f"--- Processing {name} ({cpu_type}) ---")
-        public_ip = get_public_ip(ssh_host, cpu_type)
-        
-        if not public_ip:
-            print(f"Could not get public IP for {name}. Skipping update.")
-            continue
-
-        print(f"Resolved IP: {public_ip}")
-
-        if name in current_monitors:
-            monitor = current_monitors[name]
-            old_ip = monitor.get('url')
-            if old_ip != public_ip:
-                print(f"IP changed for {name} ({old_ip} -> {public_ip}). Updating...")
-                update_monitor(monitor['id'], name, public_ip)
+            logger.info("--- Processing %s (%s) ---", name, cpu_type)
+            if isinstance(public_ip, Exception):
+                logger.error("Error checking %s: %s", server['ssh_host'], public_ip)
+                public_ip = None
+
+            if not public_ip:
+                logger.warning("Could not get public IP for %s. Skipping update.", name)
+                continue
+
+            logger.info("Resolved IP: %s", public_ip)
+
+            if name in current_monitors:
+                monitor = current_monitors[name]
+                old_ip = monitor.get('url')
+                if normalize_ip(old_ip) != public_ip:
+                    logger.info("IP changed for %s (%s -> %s). Updating...", name, old_ip, public_ip)
+                    ops.append(update_monitor(session, monitor['id'], name, public_ip))
+                else:
+                    logger.info("IP unchanged for %s. No action.", name)
             else:
-                print(f"IP unchanged for {name}. No action.")
-        else:
-            print(f"Monitor {name} does not exist. Creating...")
-            create_monitor(name, public_ip)
+                logger.info("Monitor %s does not exist. Creating...", name)
+                ops.append(create_monitor(session, name, public_ip))
+
+        await asyncio.gather(*ops)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())